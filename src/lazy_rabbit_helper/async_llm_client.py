@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
 import os
 import sys
+import time
 
 from typing import Type, List, Union
 from pydantic import BaseModel
 from openai import AsyncOpenAI
+import httpx
 from typing import Iterable, Literal
 import instructor
 from instructor.exceptions import InstructorRetryException
 
 from common_util import logger
 from common_util import LazyLlmError, str2bool
+from llm_cassette import create_transport, MODE_OFF, MODE_REPLAY
+
+# keep the pooled connection long enough to survive between selecting a prompt and clicking perform
+KEEPALIVE_SECONDS = 60
+WARM_UP_INTERVAL_SECONDS = 30
+WARM_UP_TIMEOUT_SECONDS = 5
 
 class AsyncLlmClient:
 
@@ -19,15 +27,55 @@ class AsyncLlmClient:
         self._base_url= kwargs.get("base_url", os.getenv("LLM_BASE_URL"))
         self._model = kwargs.get("model", os.getenv("LLM_MODEL"))
         self._stream = str2bool(kwargs.get("stream", os.getenv("LLM_STREAM")))
-        self._client = AsyncOpenAI(api_key=self._api_key, base_url=self._base_url)
+        self._cassette_mode = str(kwargs.get("cassette_mode") or os.getenv("LLM_CASSETTE_MODE") or MODE_OFF).lower()
+        self._cassette_file = kwargs.get("cassette_file") or os.getenv("LLM_CASSETTE_FILE")
+        replay_delay_scale = kwargs.get("replay_delay_scale")
+        if replay_delay_scale is None:
+            # 0 is a valid scale which replays without delay
+            replay_delay_scale = os.getenv("LLM_REPLAY_DELAY_SCALE", 1.0)
+        self._replay_delay_scale = float(replay_delay_scale)
+        transport = create_transport(self._cassette_mode, self._cassette_file, self._replay_delay_scale,
+                                     limits=httpx.Limits(keepalive_expiry=KEEPALIVE_SECONDS))
+        self._http_client = httpx.AsyncClient(transport=transport)
+        # a replayed exchange is deterministic, retrying a missing one would only add backoff delays
+        max_retries = 0 if self._cassette_mode == MODE_REPLAY else 2
+        api_key = self._api_key or ("replay" if self._cassette_mode == MODE_REPLAY else None)
+        self._client = AsyncOpenAI(api_key=api_key, base_url=self._base_url,
+                                   http_client=self._http_client, max_retries=max_retries)
+        self._last_warm_up_time = 0.0
         self._instructor = instructor.from_openai(self._client, mode=instructor.Mode.TOOLS)
         self._max_retry_count = 2
     def get_openai_client(self):
         return self._client
 
+    def get_model(self):
+        return self._model
+
+    async def warm_up(self) -> bool:
+        """
+        Open the TCP/TLS connection to base_url in the shared pool ahead of a request.
+        It only sends a HEAD request to the base url, never a completion, and at most once per interval.
+        """
+        if not self._base_url or self._cassette_mode != MODE_OFF:
+            # a warm-up would be recorded into the cassette, or has nothing to warm up in replay
+            return False
+        now = time.monotonic()
+        if now - self._last_warm_up_time < WARM_UP_INTERVAL_SECONDS:
+            return False
+        self._last_warm_up_time = now
+        try:
+            await self._http_client.head(str(self._base_url), timeout=WARM_UP_TIMEOUT_SECONDS)
+        except httpx.HTTPError as e:
+            logger.debug(f"warm up {self._base_url} failed: {e}")
+            return False
+        return True
+
     async def get_llm_response(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
         messages = [{"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}]
+        return await self.get_chat_response(messages, **kwargs)
+
+    async def get_chat_response(self, messages: list[dict], **kwargs) -> str:
         #logger.debug(f"{self._base_url}, {self._model}, {self._stream}: {messages}")
         response = await self._client.chat.completions.create(
             model=self._model,
@@ -37,6 +85,16 @@ class AsyncLlmClient:
         return response.choices[0].message.content
 
 
+    async def stream_chat_response(self, messages: list[dict], **kwargs):
+        response = await self._client.chat.completions.create(
+            model=self._model,
+            messages=messages,
+            stream=True,
+        ) # type: ignore
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
     async def get_json_response(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
         messages = [{"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}]
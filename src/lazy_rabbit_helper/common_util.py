@@ -20,6 +20,9 @@ def setup_logging():
 # Use the standard logging logger
 logger = logging.getLogger(__name__)
 
+NUMBER_PATTERN = re.compile(r'\d+\.\d+|\d+')
+MARKDOWN_BLOCK_PATTERN = re.compile(r"```markdown\n(.*?)\n```", re.DOTALL)
+
 class LazyLlmError(Exception):
     def __init__(self, reason, original_exception):
         self.reason = reason
@@ -63,7 +66,7 @@ def measurements_dict2list(measurements_dict: dict[str, dict]):
     return results
 
 def extract_numbers(text):
-    numbers = re.findall(r'\d+\.\d+|\d+', text)
+    numbers = NUMBER_PATTERN.findall(text)
     return [float(num) for num in numbers]
 
 def task_csv_to_json(csv_str: str) -> str:
@@ -73,7 +76,7 @@ def task_csv_to_json(csv_str: str) -> str:
     return json.dumps(data, indent=2, ensure_ascii=False)
 
 def extract_markdown_text(text):
-    match = re.search(r"```markdown\n(.*?)\n```", text, re.DOTALL)
+    match = MARKDOWN_BLOCK_PATTERN.search(text)
     return match.group(1) if match else None
 
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import os, sys
+import re
+import json
+import asyncio
+import hashlib
+import argparse
+import datetime
+import threading
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(CURRENT_DIR))
+from llm_service import LlmService, get_llm_service_instance, read_llm_config
+from yaml_config import YamlConfig
+from common_util import logger, LazyLlmError
+
+PERIOD_WEEK = "week"
+PERIOD_MONTH = "month"
+DIARY_FILE_PATTERN = re.compile(r"^diary_(\d{8})\.md$")
+REPORT_CACHE_FILE = ".report_cache.json"
+DEFAULT_CONCURRENCY = 4
+# a monthly report of last month still needs the summaries of up to two months ago
+CACHE_EXPIRE_SECONDS = 92 * 24 * 3600
+DAY_PROMPT_NAME = "summarize"
+REPORT_PROMPT_NAMES = {PERIOD_WEEK: "weekly_report", PERIOD_MONTH: "monthly_report"}
+
+def get_period_range(period: str, day: datetime.date) -> tuple[datetime.date, datetime.date]:
+    if period == PERIOD_WEEK:
+        start = day - datetime.timedelta(days=day.weekday())
+        return start, start + datetime.timedelta(days=6)
+    if period == PERIOD_MONTH:
+        start = day.replace(day=1)
+        next_month = (start + datetime.timedelta(days=32)).replace(day=1)
+        return start, next_month - datetime.timedelta(days=1)
+    raise ValueError(f"unknown period {period}, expect {PERIOD_WEEK} or {PERIOD_MONTH}")
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("UTF-8")).hexdigest()
+
+
+class DiaryReporter:
+    """
+    Build weekly or monthly reports from the diary_YYYYMMDD.md files of a folder.
+
+    Each day is summarized once: the summaries are memoized by the sha1 of the model and the rendered prompt,
+    which contains the diary, so only new or edited days ask the LLM, concurrently, and an edited template
+    or another model summarizes them again. The rollup of the summaries into the report is memoized the same way,
+    an unchanged period costs no LLM call at all. The entries not used for about three months are dropped.
+    """
+
+    def __init__(self, llm_service: LlmService, folder: str, concurrency: int = DEFAULT_CONCURRENCY):
+        self._llm_service = llm_service
+        self._folder = folder
+        self._concurrency = concurrency
+        self._cache_file = os.path.join(folder, REPORT_CACHE_FILE)
+        self._lock = threading.Lock()
+        self._cache = self._load_cache()
+
+    def _load_cache(self) -> dict:
+        if not os.path.exists(self._cache_file):
+            return {"days": {}, "reports": {}}
+        try:
+            with open(self._cache_file, "r", encoding="UTF-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"cannot load report cache {self._cache_file}: {e}")
+            return {"days": {}, "reports": {}}
+
+    def _save_cache(self):
+        with self._lock:
+            expire_time = time.time() - CACHE_EXPIRE_SECONDS
+            for section in ("days", "reports"):
+                entries = self._cache[section]
+                for digest in [k for k, v in entries.items() if not isinstance(v, dict) or v.get("last_used", 0) < expire_time]:
+                    del entries[digest]
+            tmp_file = f"{self._cache_file}.tmp"
+            with open(tmp_file, "w", encoding="UTF-8") as f:
+                json.dump(self._cache, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_file, self._cache_file)
+
+    def find_diaries(self, start: datetime.date, end: datetime.date) -> list[tuple[datetime.date, str]]:
+        diaries = []
+        for file_name in os.listdir(self._folder):
+            match = DIARY_FILE_PATTERN.match(file_name)
+            if not match:
+                continue
+            try:
+                day = datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+            except ValueError:
+                continue
+            if start <= day <= end:
+                diaries.append((day, os.path.join(self._folder, file_name)))
+        return sorted(diaries)
+
+    async def summarize_day(self, day: datetime.date, file_path: str) -> str | None:
+        with open(file_path, "r", encoding="UTF-8") as f:
+            content = f.read().strip()
+        if not content:
+            return None
+        prompt = self._llm_service.get_prompt_templates().get_prompt_tpl(DAY_PROMPT_NAME)
+        user_prompt = self._llm_service.build_prompt({"text": content}, prompt["user_prompt"])
+        digest = self._get_prompt_hash(prompt["system_prompt"], user_prompt)
+        cached = self._cache["days"].get(digest)
+        if cached:
+            cached["last_used"] = time.time()
+            return cached["summary"]
+        summary = await self._llm_service.ask(prompt["system_prompt"], user_prompt)
+        # drop the summary of an older version of the same day and persist at once,
+        # so a failure of another day does not lose it
+        for old_digest in [k for k, v in self._cache["days"].items() if v.get("date") == day.isoformat()]:
+            del self._cache["days"][old_digest]
+        self._cache["days"][digest] = {"date": day.isoformat(), "summary": summary, "last_used": time.time()}
+        self._save_cache()
+        logger.info(f"summarized diary of {day}")
+        return summary
+
+    def _get_prompt_hash(self, system_prompt: str, user_prompt: str) -> str:
+        model = self._llm_service.get_llm_client().get_model()
+        return content_hash(f"{model}\n{system_prompt}\n{user_prompt}")
+
+    async def build_report(self, period: str, day: datetime.date) -> str:
+        start, end = get_period_range(period, day)
+        diaries = self.find_diaries(start, end)
+        if not diaries:
+            return ""
+
+        semaphore = asyncio.Semaphore(self._concurrency)
+        async def summarize(day, file_path):
+            async with semaphore:
+                return await self.summarize_day(day, file_path)
+
+        summaries = await asyncio.gather(*[summarize(day, file_path) for day, file_path in diaries], return_exceptions=True)
+        self._save_cache()
+        errors = [(day, e) for (day, _), e in zip(diaries, summaries) if isinstance(e, Exception)]
+        if errors:
+            # the summaries of the other days are cached, a retry only asks for the failed ones
+            for day, e in errors:
+                logger.error(f"cannot summarize diary of {day}: {e}")
+            raise LazyLlmError(f"cannot summarize {len(errors)} of {len(diaries)} days", errors[0][1])
+        daily_summaries = "\n\n".join(f"### {day.isoformat()}\n{summary}"
+                                      for (day, _), summary in zip(diaries, summaries) if summary)
+
+        prompt = self._llm_service.get_prompt_templates().get_prompt_tpl(REPORT_PROMPT_NAMES[period])
+        user_prompt = self._llm_service.build_prompt({"start_date": start.isoformat(), "end_date": end.isoformat(),
+                                                      "daily_summaries": daily_summaries}, prompt["user_prompt"])
+        digest = self._get_prompt_hash(prompt["system_prompt"], user_prompt)
+        cached = self._cache["reports"].get(digest)
+        if isinstance(cached, dict):
+            cached["last_used"] = time.time()
+            self._save_cache()
+            return cached["report"]
+        report = await self._llm_service.ask(prompt["system_prompt"], user_prompt)
+        self._cache["reports"][digest] = {"report": report, "last_used": time.time()}
+        self._save_cache()
+        return report
+
+
+if __name__ == "__main__":
+    import dotenv
+    dotenv.load_dotenv()
+    parser = argparse.ArgumentParser(description="Build weekly or monthly report from diary files")
+    parser.add_argument('-f', '--config_file', action='store', dest='config_file', default="./etc/sticky_note.yaml", help='Path to the YAML configuration file')
+    parser.add_argument('-p', '--prompt_file', action='store', dest='prompt_file', default="./etc/prompt_template.yaml", help='Path to the prompt template file')
+    parser.add_argument('-r', '--period', action='store', dest='period', default=PERIOD_WEEK, choices=[PERIOD_WEEK, PERIOD_MONTH], help='report period')
+    parser.add_argument('-d', '--date', action='store', dest='date', help='any day in the period as YYYYMMDD, default today')
+    args = parser.parse_args()
+
+    config = YamlConfig(args.config_file)
+    folder = config.get_config_item_2("config", "folder") or os.getcwd()
+    day = datetime.datetime.strptime(args.date, "%Y%m%d").date() if args.date else datetime.date.today()
+    llm_service = get_llm_service_instance(read_llm_config(config), args.prompt_file)
+    reporter = DiaryReporter(llm_service, folder)
+    print(asyncio.run(reporter.build_report(args.period, day)))
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+
+from common_util import logger
+
+MODE_OFF = "off"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+CASSETTE_MODES = (MODE_OFF, MODE_RECORD, MODE_REPLAY)
+# headers which are not needed to replay a response, or which would be wrong after replaying it
+SKIPPED_HEADERS = ("set-cookie", "date", "content-length", "transfer-encoding", "connection")
+
+class CassetteMissError(httpx.TransportError):
+    pass
+
+def get_request_key(method: str, url: str, body: bytes) -> str:
+    # the same request body serialized in another key order must still match
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True).encode("UTF-8")
+    except ValueError:
+        pass
+    digest = hashlib.sha1(body).hexdigest()
+    return f"{method} {urlsplit(url).path} {digest}"
+
+
+class RecordingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, entry: dict, started: float, on_done):
+        self._stream = stream
+        self._entry = entry
+        self._last_time = started
+        self._on_done = on_done
+        self._done = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            now = time.monotonic()
+            self._entry["chunks"].append([round(now - self._last_time, 4), base64.b64encode(chunk).decode("ascii")])
+            self._last_time = now
+            yield chunk
+
+    async def aclose(self):
+        await self._stream.aclose()
+        if not self._done:
+            self._done = True
+            self._on_done(self._entry)
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """
+    Forward the requests to the wrapped transport and append each exchange to a cassette file,
+    one json line per request with the raw response chunks and the delay before each of them.
+    The request headers, including the api key, are never written.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, cassette_file: str):
+        self._transport = transport
+        self._cassette_file = cassette_file
+        self._lock = threading.Lock()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        started = time.monotonic()
+        response = await self._transport.handle_async_request(request)
+        entry = {
+            "key": get_request_key(request.method, str(request.url), body),
+            "request": body.decode("UTF-8", errors="replace"),
+            "status": response.status_code,
+            "headers": [[k, v] for k, v in response.headers.items() if k.lower() not in SKIPPED_HEADERS],
+            "wait": round(time.monotonic() - started, 4),
+            "chunks": []
+        }
+        stream = RecordingStream(response.stream, entry, time.monotonic(), self._write_entry) # type: ignore
+        return httpx.Response(response.status_code, headers=response.headers, stream=stream,
+                              extensions=response.extensions)
+
+    def _write_entry(self, entry: dict):
+        with self._lock:
+            with open(self._cassette_file, "a", encoding="UTF-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: list, delay_scale: float):
+        self._chunks = chunks
+        self._delay_scale = delay_scale
+
+    async def __aiter__(self):
+        for delay, data in self._chunks:
+            if self._delay_scale > 0 and delay > 0:
+                await asyncio.sleep(delay * self._delay_scale)
+            yield base64.b64decode(data)
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """
+    Serve the responses from a cassette file without any network access.
+    Requests with the same key are answered in recorded order, the last answer is reused after that.
+    delay_scale 1.0 replays at the recorded speed, 0 without any delay, 2.0 twice as slow.
+    """
+
+    def __init__(self, cassette_file: str, delay_scale: float = 1.0):
+        self._delay_scale = float(delay_scale)
+        self._cassette_file = cassette_file
+        self._entries: dict[str, list[dict]] = {}
+        self._cursors: dict[str, int] = {}
+        with open(cassette_file, "r", encoding="UTF-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+        logger.info(f"loaded {sum(len(v) for v in self._entries.values())} exchanges from {cassette_file}")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = get_request_key(request.method, str(request.url), body)
+        entries = self._entries.get(key)
+        if not entries:
+            # the openai client wraps the error into a plain "Connection error.", so log the miss here
+            logger.warning(f"replay miss in {self._cassette_file}: no recorded response for {request.method} {request.url}, "
+                           f"key={key}, record it with cassette mode 'record'")
+            raise CassetteMissError(f"no recorded response for {key}", request=request)
+        cursor = self._cursors.get(key, 0)
+        entry = entries[min(cursor, len(entries) - 1)]
+        self._cursors[key] = cursor + 1
+        if self._delay_scale > 0 and entry["wait"] > 0:
+            await asyncio.sleep(entry["wait"] * self._delay_scale)
+        return httpx.Response(entry["status"], headers=entry["headers"],
+                              stream=ReplayStream(entry["chunks"], self._delay_scale), request=request)
+
+
+def create_transport(mode: str, cassette_file: str, delay_scale: float = 1.0, **kwargs) -> httpx.AsyncBaseTransport:
+    mode = (mode or MODE_OFF).lower()
+    if mode not in CASSETTE_MODES:
+        raise ValueError(f"unknown cassette mode {mode}, expect one of {CASSETTE_MODES}")
+    if mode != MODE_OFF and not cassette_file:
+        raise ValueError(f"cassette file is required in {mode} mode")
+    if mode == MODE_REPLAY:
+        return ReplayTransport(cassette_file, delay_scale)
+    transport = httpx.AsyncHTTPTransport(**kwargs)
+    if mode == MODE_RECORD:
+        os.makedirs(os.path.dirname(os.path.abspath(cassette_file)), exist_ok=True)
+        return RecordingTransport(transport, cassette_file)
+    return transport
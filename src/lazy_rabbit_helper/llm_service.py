@@ -10,6 +10,8 @@ sys.path.append(os.path.dirname(CURRENT_DIR))
 import asyncio
 from async_llm_client import AsyncLlmClient, str2bool
 from yaml_config import YamlConfig
+from prompt_cache import SimilarPromptCache, SimilarHit, DEFAULT_THRESHOLD, DEFAULT_MAX_ENTRIES
+from llm_session import LlmSession, DEFAULT_TOKEN_BUDGET, COMPACT_SYSTEM_PROMPT, get_session_path
 
 from common_util import logger
 
@@ -26,7 +28,16 @@ def read_llm_config(config: YamlConfig):
     api_key = config.get_config_item_2("llm", "api_key") or os.getenv("LLM_API_KEY")
     model = config.get_config_item_2("llm", "model") or os.getenv("LLM_MODEL")
     stream = config.get_config_item_2("llm", "stream") or os.getenv("LLM_STREAM")
-    return LlmConfig(base_url=base_url, api_key=api_key, model=model, stream=stream)
+    cassette_mode = config.get_config_item_2("llm", "cassette_mode") or os.getenv("LLM_CASSETTE_MODE")
+    cassette_file = config.get_config_item_2("llm", "cassette_file") or os.getenv("LLM_CASSETTE_FILE")
+    replay_delay_scale = config.get_config_item_2("llm", "replay_delay_scale")
+    if replay_delay_scale is None:
+        replay_delay_scale = os.getenv("LLM_REPLAY_DELAY_SCALE", 1.0)
+    similar_cache_file = config.get_config_item_2("llm", "similar_cache_file") or os.getenv("LLM_SIMILAR_CACHE_FILE")
+    similar_cache_size = config.get_config_item_2("llm", "similar_cache_size") or os.getenv("LLM_SIMILAR_CACHE_SIZE", DEFAULT_MAX_ENTRIES)
+    return LlmConfig(base_url=base_url, api_key=api_key, model=model, stream=stream,
+                     cassette_mode=cassette_mode, cassette_file=cassette_file, replay_delay_scale=replay_delay_scale,
+                     similar_cache_file=similar_cache_file, similar_cache_size=similar_cache_size)
 
 
 class PromptTemplates:
@@ -46,15 +57,29 @@ class LlmConfig:
     api_key: str
     model: str
     stream: bool
+    cassette_mode: str
+    cassette_file: str
+    replay_delay_scale: float
+    similar_cache_file: str
+    similar_cache_size: int
 
     def __init__(self, **kwargs):
         self.base_url = kwargs.get("base_url", os.getenv("LLM_BASE_URL"))
         self.api_key = kwargs.get("api_key", os.getenv("LLM_API_KEY"))
         self.model = kwargs.get("model", os.getenv("LLM_MODEL"))
         self.stream = str2bool(kwargs.get("stream", os.getenv("LLM_STREAM")))
+        self.cassette_mode = kwargs.get("cassette_mode", os.getenv("LLM_CASSETTE_MODE"))
+        self.cassette_file = kwargs.get("cassette_file", os.getenv("LLM_CASSETTE_FILE"))
+        replay_delay_scale = kwargs.get("replay_delay_scale")
+        if replay_delay_scale is None:
+            replay_delay_scale = os.getenv("LLM_REPLAY_DELAY_SCALE", 1.0)
+        self.replay_delay_scale = float(replay_delay_scale)
+        self.similar_cache_file = kwargs.get("similar_cache_file", os.getenv("LLM_SIMILAR_CACHE_FILE"))
+        self.similar_cache_size = int(kwargs.get("similar_cache_size", os.getenv("LLM_SIMILAR_CACHE_SIZE", DEFAULT_MAX_ENTRIES)))
 
     def __repr__(self) -> str:
-        return f"LlmConfig(base_url={self.base_url}, api_key={self.api_key}, model={self.model}, stream={self.stream})"
+        return (f"LlmConfig(base_url={self.base_url}, api_key={self.api_key}, model={self.model}, stream={self.stream}, "
+                f"cassette_mode={self.cassette_mode}, cassette_file={self.cassette_file})")
 
     def __hash__(self):
         return hash((self.base_url, self.api_key, self.model, self.stream))
@@ -69,9 +94,17 @@ class LlmService:
         self._llm_client = AsyncLlmClient(base_url=llm_config.base_url,
             api_key=llm_config.api_key,
             model=llm_config.model,
-            stream=llm_config.stream)
+            stream=llm_config.stream,
+            cassette_mode=llm_config.cassette_mode,
+            cassette_file=llm_config.cassette_file,
+            replay_delay_scale=llm_config.replay_delay_scale)
         if prompt_config_file:
             self._prompt_templates = PromptTemplates(prompt_config_file)
+        self._compiled_templates: dict[str, Template] = {}
+        self._similar_cache = None
+        if llm_config.similar_cache_file:
+            self._similar_cache = SimilarPromptCache(llm_config.similar_cache_file, llm_config.similar_cache_size)
+        self._rendered_prompts: dict[str, str] = {}
 
     def get_llm_client(self):
         return self._llm_client
@@ -82,21 +115,96 @@ class LlmService:
     def get_default_system_prompt(self):
         return self._prompt_templates.get_prompt_tpl("system_prompt")
 
+    def get_compiled_template(self, prompt_tpl: str) -> Template:
+        template = self._compiled_templates.get(prompt_tpl)
+        if template is None:
+            template = Template(prompt_tpl)
+            self._compiled_templates[prompt_tpl] = template
+        return template
+
     def build_user_prompt(self, data_dict: dict, prompt_name='user_prompt') -> str:
         user_prompt_tpl = self._prompt_templates.get_prompt_tpl(prompt_name)
-        template = Template(user_prompt_tpl)
+        template = self.get_compiled_template(user_prompt_tpl)
         rendered_str = template.render(data_dict)
         return rendered_str
 
     def build_prompt(self, data_dict: dict, user_prompt_tpl: str) -> str:
-        template = Template(user_prompt_tpl)
+        template = self.get_compiled_template(user_prompt_tpl)
         rendered_str = template.render(data_dict)
         return rendered_str
 
+    def prepare_prompt(self, prompt_name: str) -> str:
+        """render the prompt with its default variables, the result is kept for the next selection"""
+        rendered = self._rendered_prompts.get(prompt_name)
+        if rendered is None:
+            prompt = self._prompt_templates.get_prompt_tpl(prompt_name)
+            rendered = self.build_prompt(prompt.get("variables") or {},
+                                         f"{prompt.get('system_prompt', '')}\n{prompt.get('user_prompt', '')}")
+            self._rendered_prompts[prompt_name] = rendered
+        return rendered
+
+    async def warm_up(self) -> bool:
+        return await self._llm_client.warm_up()
+
+    def get_similar_threshold(self, prompt_name: str) -> float | None:
+        """the similarity cache is opt-in per template by `similar_cache: true` or a threshold in its config"""
+        if self._similar_cache is None or not prompt_name:
+            return None
+        prompt = self._prompt_templates.get_prompt_tpl(prompt_name)
+        option = prompt.get("similar_cache") if isinstance(prompt, dict) else None
+        if option is None or option is False:
+            return None
+        return DEFAULT_THRESHOLD if option is True else float(option)
+
+    def lookup_similar(self, prompt_name: str, system_prompt: str, user_prompt: str) -> SimilarHit | None:
+        threshold = self.get_similar_threshold(prompt_name)
+        if threshold is None:
+            return None
+        hit = self._similar_cache.lookup(prompt_name, f"{system_prompt}\n{user_prompt}", threshold)
+        if hit:
+            logger.info(f"similar cache hit of {prompt_name}: {hit}")
+        return hit
+
+    def remember_answer(self, prompt_name: str, system_prompt: str, user_prompt: str, answer: str):
+        if self.get_similar_threshold(prompt_name) is not None:
+            self._similar_cache.put(prompt_name, f"{system_prompt}\n{user_prompt}", answer)
+
     async def ask(self, system_prompt, user_prompt) -> str:
+        # no similar cache here: its answers may be approximate, the callers check lookup_similar themselves
         logger.debug(f"Ask LLM for str: {system_prompt}, {user_prompt}.")
         return await self._llm_client.get_llm_response(system_prompt, user_prompt)
 
+    def open_session(self, note_path: str, system_prompt: str = "", token_budget: int = DEFAULT_TOKEN_BUDGET) -> LlmSession:
+        return LlmSession.load(get_session_path(note_path), system_prompt, token_budget)
+
+    async def ask_in_session(self, session: LlmSession, user_prompt: str) -> str:
+        if session.need_compact(user_prompt):
+            await self.compact_session(session, user_prompt)
+        messages = session.build_messages(user_prompt)
+        logger.debug(f"Ask LLM in session: {session}, {user_prompt}.")
+        answer = await self._llm_client.get_chat_response(messages)
+        session.add_turn(user_prompt, answer)
+        session.save()
+        return answer
+
+    async def stream_in_session(self, session: LlmSession, user_prompt: str):
+        if session.need_compact(user_prompt):
+            await self.compact_session(session, user_prompt)
+        messages = session.build_messages(user_prompt)
+        logger.debug(f"Stream LLM in session: {session}, {user_prompt}.")
+        chunks = []
+        async for chunk in self._llm_client.stream_chat_response(messages):
+            chunks.append(chunk)
+            yield chunk
+        session.add_turn(user_prompt, "".join(chunks))
+        session.save()
+
+    async def compact_session(self, session: LlmSession, user_prompt: str = ""):
+        count = session.get_compact_count(user_prompt)
+        summary = await self._llm_client.get_llm_response(COMPACT_SYSTEM_PROMPT, session.get_compact_prompt(count))
+        session.apply_compact(summary, count)
+        logger.info(f"compacted session: {session}, tokens={session.count_tokens()}")
+
     async def ask_as_json_str(self, system_prompt, user_prompt) -> str:
         logger.debug(f"Ask LLM for json: {system_prompt}, {user_prompt}.")
         return await self._llm_client.get_json_response(system_prompt, user_prompt)
@@ -0,0 +1,159 @@
+import os
+import json
+
+from common_util import logger
+
+DEFAULT_TOKEN_BUDGET = 4096
+DEFAULT_KEEP_TURNS = 2
+# a compaction folds turns until the prompt is under this share of the budget,
+# so there is room for several turns before the next one and the prefix stays unchanged in between
+COMPACT_TARGET_RATIO = 0.5
+SUMMARY_MAX_RATIO = 0.25
+SESSION_FILE_SUFFIX = ".session.json"
+
+COMPACT_SYSTEM_PROMPT = "You are an expert summarizer of conversations."
+COMPACT_USER_PROMPT = """Merge the previous summary and the following conversation turns into one concise summary.
+Keep facts, decisions, names, numbers and open questions, drop greetings and repetitions.
+
+Previous summary:
+{summary}
+
+Conversation turns:
+{turns}
+"""
+
+def estimate_tokens(text: str) -> int:
+    # rough estimation without a tokenizer: ~4 ascii chars per token, 1 token per CJK char
+    if not text:
+        return 0
+    ascii_count = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_count // 4 + (len(text) - ascii_count) + 1
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # cut on the estimation of the prefix, it is only meant to keep the prompt within budget
+    end = len(text)
+    while end > 0 and estimate_tokens(text[:end]) > max_tokens:
+        end = end * 3 // 4
+    return text[:end]
+
+def get_session_path(note_path: str) -> str:
+    return f"{note_path}{SESSION_FILE_SUFFIX}"
+
+
+class LlmSession:
+    """
+    Conversation history of the AI tool with a token budget.
+
+    The messages are always laid out as [system prompt, summary, turns..., new user prompt],
+    so the prefix only changes when older turns are compacted into the summary,
+    which keeps the prefix cache of the LLM provider hitting between compactions.
+    """
+
+    def __init__(self, system_prompt: str = "", token_budget: int = DEFAULT_TOKEN_BUDGET,
+                 keep_turns: int = DEFAULT_KEEP_TURNS, session_file: str = None):
+        self.system_prompt = system_prompt or ""
+        self.token_budget = int(token_budget)
+        self.keep_turns = int(keep_turns)
+        self.session_file = session_file
+        self.summary = ""
+        self.turns: list[dict] = []
+
+    def build_messages(self, user_prompt: str) -> list[dict]:
+        messages = [{"role": "system", "content": self.system_prompt}]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"})
+        for turn in self.turns:
+            messages.append({"role": "user", "content": turn["user"]})
+            messages.append({"role": "assistant", "content": turn["assistant"]})
+        messages.append({"role": "user", "content": user_prompt})
+        return messages
+
+    def add_turn(self, user_prompt: str, answer: str):
+        self.turns.append({"user": user_prompt, "assistant": answer})
+
+    def count_tokens(self, user_prompt: str = "") -> int:
+        return sum(estimate_tokens(msg["content"]) for msg in self.build_messages(user_prompt))
+
+    def get_compact_count(self, user_prompt: str = "") -> int:
+        """the number of the oldest turns to fold into the summary when the next prompt exceeds the budget"""
+        tokens = self.count_tokens(user_prompt)
+        if not self.turns or tokens <= self.token_budget:
+            return 0
+        target = int(self.token_budget * COMPACT_TARGET_RATIO)
+        count = 0
+        while count < len(self.turns) and tokens > target:
+            tokens -= self._count_turn_tokens(self.turns[count:count + 1])
+            count += 1
+        # fold at least all the turns but the recent ones
+        return max(count, len(self.turns) - self.keep_turns)
+
+    def _count_turn_tokens(self, turns: list[dict]) -> int:
+        return sum(estimate_tokens(t["user"]) + estimate_tokens(t["assistant"]) for t in turns)
+
+    def need_compact(self, user_prompt: str = "") -> bool:
+        return self.get_compact_count(user_prompt) > 0
+
+    def get_compact_prompt(self, count: int) -> str:
+        turns_str = "\n".join(f"user: {t['user']}\nassistant: {t['assistant']}" for t in self.turns[:count])
+        return COMPACT_USER_PROMPT.format(summary=self.summary or "(none)", turns=turns_str)
+
+    def apply_compact(self, summary: str, count: int):
+        # drop the turns which have been folded into the summary, the summary takes at most a quarter of the budget
+        self.summary = truncate_to_tokens(summary.strip(), int(self.token_budget * SUMMARY_MAX_RATIO))
+        self.turns = self.turns[count:]
+
+    def switch_system_prompt(self, system_prompt: str) -> bool:
+        """
+        A session keeps one system prompt, so the prefix of its messages stays stable.
+        Another system prompt starts a new session, return True if some history has been dropped.
+        """
+        system_prompt = system_prompt or ""
+        if system_prompt == self.system_prompt:
+            return False
+        had_history = bool(self.turns or self.summary)
+        self.clear()
+        self.system_prompt = system_prompt
+        return had_history
+
+    def clear(self):
+        self.summary = ""
+        self.turns = []
+
+    def to_dict(self) -> dict:
+        return {
+            "system_prompt": self.system_prompt,
+            "token_budget": self.token_budget,
+            "keep_turns": self.keep_turns,
+            "summary": self.summary,
+            "turns": self.turns
+        }
+
+    def save(self):
+        if not self.session_file:
+            return
+        with open(self.session_file, "w", encoding="UTF-8") as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, session_file: str, system_prompt: str = "", token_budget: int = DEFAULT_TOKEN_BUDGET,
+             keep_turns: int = DEFAULT_KEEP_TURNS) -> "LlmSession":
+        session = cls(system_prompt, token_budget, keep_turns, session_file)
+        if not os.path.exists(session_file):
+            return session
+        try:
+            with open(session_file, "r", encoding="UTF-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"cannot load session {session_file}: {e}")
+            return session
+        session.system_prompt = data.get("system_prompt", "")
+        session.summary = data.get("summary", "")
+        session.turns = data.get("turns", [])
+        if system_prompt:
+            session.switch_system_prompt(system_prompt)
+        return session
+
+    def __repr__(self) -> str:
+        return f"LlmSession(turns={len(self.turns)}, summary_len={len(self.summary)}, budget={self.token_budget})"
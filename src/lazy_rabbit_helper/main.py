@@ -14,10 +14,16 @@ from PyQt5.QtWidgets import (
     QVBoxLayout, QScrollArea, QScrollBar
 )
 from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QTextCursor
 from jinja2 import Template
 from yaml_config import YamlConfig
 from common_util import task_csv_to_json, extract_markdown_text, open_link
 from llm_service import get_llm_service_instance, read_llm_config
+from llm_session import DEFAULT_TOKEN_BUDGET
+from llm_cassette import MODE_REPLAY
+from note_snapshot import NoteSnapshotStore
+from diary_report import DiaryReporter, PERIOD_WEEK, PERIOD_MONTH
+from stream_extractor import StreamPipeline, FileSink, KIND_CODE, KIND_MARKDOWN
 from common_util import logger
 import dotenv
 dotenv.load_dotenv()
@@ -27,6 +33,8 @@ DEFAULT_MINS = 25
 TIME_FORMAT = "%H:%M:%S"
 DATE_FORMAT = "%Y%m%d"
 FULL_TIME_FORMAT = "%Y%m%d_%H%M%S"
+ASYNC_TICK_MS = 10
+BLOCK_ACTIONS = ["none", "insert into note", "save to file", "copy"]
 
 
 def get_resource_path(relative_path):
@@ -52,8 +60,9 @@ class StickyNote(QMainWindow):
         self._left_seconds = 0
 
         self._llm_config = read_llm_config(self._config)
+        self._session_token_budget = int(self._config.get_config_item_2("llm", "session_token_budget") or DEFAULT_TOKEN_BUDGET)
 
-        if self._llm_config.api_key:
+        if self._llm_config.api_key or str(self._llm_config.cassette_mode).lower() == MODE_REPLAY:
             self._llm_service = get_llm_service_instance(self._llm_config, prompt_config_file)
         self._folder = self._config.get_config_item_2("config", "folder")
         if not self._folder:
@@ -65,6 +74,8 @@ class StickyNote(QMainWindow):
         self.default_filename = f"diary_{self.datestr}.md"
         self.auto_save_interval = int(self._config.get_config_item_2("config", "save_interval_ms"))
         self.last_modified_time = None
+        self._snapshot_stores = {}
+        self._snapshot_compact_interval = int(self._config.get_config_item_2("config", "snapshot_compact_interval_ms") or 3600000)
         self.commands = self._config.get_config_item_2("config", "commands")
         self.command_dict = {}
         self._templates = self._config.get_config_item("templates")
@@ -152,8 +163,10 @@ class StickyNote(QMainWindow):
         # Async loop
         self._loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self._loop)
+        QTimer.singleShot(ASYNC_TICK_MS, self._run_async_tasks)
         self.timer.start(1000)
         QTimer.singleShot(self.auto_save_interval, self.auto_save)
+        QTimer.singleShot(self.auto_save_interval, self.compact_snapshots)
 
         # Load default note
         file_path = f"{self._folder}/{self.default_filename}"
@@ -283,6 +296,7 @@ class StickyNote(QMainWindow):
         file_menu.addAction('New', self.new_note)
         file_menu.addAction('Open', self.open_file_dialog)
         file_menu.addAction('Save', self.save_note)
+        file_menu.addAction('History', self.show_history_dialog)
         file_menu.addSeparator()
         file_menu.addAction('Exit', self.quit_app)
 
@@ -301,6 +315,10 @@ class StickyNote(QMainWindow):
             action.triggered.connect(lambda checked, url=link.get("url"): open_link(url))
             link_menu.addAction(action)
 
+        report_menu = menubar.addMenu('Report')
+        report_menu.addAction('Weekly Report', lambda: self.generate_report(PERIOD_WEEK))
+        report_menu.addAction('Monthly Report', lambda: self.generate_report(PERIOD_MONTH))
+
         help_menu = menubar.addMenu('Help')
         help_menu.addAction('About', self.show_about_dialog)
 
@@ -330,10 +348,69 @@ class StickyNote(QMainWindow):
         file_path = os.path.join(self._folder, file_name)
         with open(file_path, "w") as f:
             f.write(content)
+        self.get_snapshot_store().record(file_name, content)
         if prompt:
             QMessageBox.information(self, "Saved", f"Saved to {file_path}")
         self.last_modified_time = os.path.getmtime(file_path)
 
+    def get_snapshot_store(self):
+        if self._folder not in self._snapshot_stores:
+            self._snapshot_stores[self._folder] = NoteSnapshotStore(self._folder)
+        return self._snapshot_stores[self._folder]
+
+    def compact_snapshots(self):
+        self.get_snapshot_store().compact_in_background()
+        QTimer.singleShot(self._snapshot_compact_interval, self.compact_snapshots)
+
+    def show_history_dialog(self):
+        file_name = self.file_name_entry.text().strip()
+        store = self.get_snapshot_store()
+        snapshots = list(reversed(store.list_snapshots(file_name)))
+        if not snapshots:
+            QMessageBox.information(self, "History", f"No history of {file_name}")
+            return
+
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f"History of {file_name}")
+        dialog.resize(600, 400)
+        layout = QVBoxLayout(dialog)
+
+        version_list = QListWidget()
+        version_list.addItems([f"v{s.version}  {s.get_time_str()}" for s in snapshots])
+        layout.addWidget(version_list)
+
+        diff_text = QTextEdit()
+        diff_text.setReadOnly(True)
+        layout.addWidget(QLabel("Diff with current note:"))
+        layout.addWidget(diff_text)
+
+        btn_layout = QHBoxLayout()
+        restore_btn = QPushButton("Restore")
+        close_btn = QPushButton("Close")
+        btn_layout.addWidget(restore_btn)
+        btn_layout.addWidget(close_btn)
+        layout.addLayout(btn_layout)
+
+        def update_diff():
+            snapshot = snapshots[version_list.currentRow()]
+            current = self.text_area.toMarkdown().strip()
+            diff_text.setPlainText(store.diff(file_name, snapshot.version, current) or "(no difference)")
+
+        def on_restore():
+            if version_list.currentRow() < 0:
+                return
+            snapshot = snapshots[version_list.currentRow()]
+            reply = QMessageBox.question(dialog, "Restore", f"Restore v{snapshot.version} of {file_name}?", QMessageBox.Yes | QMessageBox.No)
+            if reply == QMessageBox.Yes:
+                self.text_area.setPlainText(store.restore(file_name, snapshot.version))
+                dialog.close()
+
+        version_list.itemSelectionChanged.connect(update_diff)
+        restore_btn.clicked.connect(on_restore)
+        close_btn.clicked.connect(dialog.close)
+
+        dialog.exec_()
+
     def open_file_dialog(self):
         path, _ = QFileDialog.getOpenFileName(self, "Select File", "", "All Files (*)")
         if path:
@@ -427,13 +504,20 @@ class StickyNote(QMainWindow):
         layout.addWidget(self.hint_text)
 
         self.output_text = QTextEdit()
-        layout.addWidget(QLabel("Output:"))
+        output_label = QLabel("Output:")
+        layout.addWidget(output_label)
         layout.addWidget(self.output_text)
 
         btn_layout = QHBoxLayout()
+        block_action_box = QComboBox()
+        block_action_box.addItems(BLOCK_ACTIONS)
+        btn_layout.addWidget(QLabel("On each block:"))
+        btn_layout.addWidget(block_action_box)
         perform_btn = QPushButton("Perform")
+        new_session_btn = QPushButton("New Session")
         cancel_btn = QPushButton("Cancel")
         btn_layout.addWidget(perform_btn)
+        btn_layout.addWidget(new_session_btn)
         btn_layout.addWidget(cancel_btn)
         layout.addLayout(btn_layout)
 
@@ -444,33 +528,124 @@ class StickyNote(QMainWindow):
 
         def update_prompt():
             selected = self.prompt_list.currentItem().text()
-            prompt = prompt_templates.get_prompt_tpl(selected)
-            rendered = self._llm_service.build_prompt(prompt["variables"], f"{prompt['system_prompt']}\n{prompt['user_prompt']}")
-            self.hint_text.setPlainText(rendered)
+            self.hint_text.setPlainText(self._llm_service.prepare_prompt(selected))
+            self.run_async(self._llm_service.warm_up())
 
-        self.prompt_list.itemSelectionChanged.connect(update_prompt)
+        def on_hover(item):
+            # speculative work only: render the template and open the connection, never ask the LLM
+            self._llm_service.prepare_prompt(item.text())
+            self.run_async(self._llm_service.warm_up())
 
-        async def ask(prompt, user_input):
-            res = await self._llm_service.ask(prompt["system_prompt"], user_input)
-            self.output_text.setPlainText(res)
+        self.prompt_list.setMouseTracking(True)
+        self.prompt_list.itemSelectionChanged.connect(update_prompt)
+        self.prompt_list.itemEntered.connect(on_hover)
+
+        # the conversation history is kept next to the note file
+        note_path = os.path.join(self._folder, self.file_name_entry.text().strip())
+        session = self._llm_service.open_session(note_path, token_budget=self._session_token_budget)
+
+        async def ask(prompt_name, prompt, user_input):
+            new_session = session.switch_system_prompt(prompt["system_prompt"])
+            pipeline = StreamPipeline()
+            block_sink = self.get_block_sink(block_action_box.currentText())
+            if block_sink:
+                pipeline.add_sink(block_sink)
+            self.output_text.clear()
+            output_label.setText("Output (new session):" if new_session else "Output:")
+            # a cached answer only fits a question asked without any earlier context
+            first_turn = not session.turns and not session.summary
+            hit = self._llm_service.lookup_similar(prompt_name, session.system_prompt, user_input) if first_turn else None
+            if hit:
+                if hit.approximate:
+                    output_label.setText(f"Output (approximate, similarity {hit.similarity:.2f}):")
+                self.output_text.setPlainText(hit.answer)
+                pipeline.feed(hit.answer)
+                session.add_turn(user_input, hit.answer)
+                session.save()
+            else:
+                async for chunk in self._llm_service.stream_in_session(session, user_input):
+                    self.output_text.moveCursor(QTextCursor.End)
+                    self.output_text.insertPlainText(chunk)
+                    pipeline.feed(chunk)
+                if first_turn and session.turns:
+                    self._llm_service.remember_answer(prompt_name, session.system_prompt, user_input, session.turns[-1]["assistant"])
+            pipeline.close()
 
         def on_perform():
             selected = self.prompt_list.currentItem().text()
             prompt = prompt_templates.get_prompt_tpl(selected)
             user_input = self.hint_text.toPlainText()
-            asyncio.run_coroutine_threadsafe(ask(prompt, user_input), self._loop)
+            self.run_async(ask(selected, prompt, user_input))
+
+        def on_new_session():
+            session.clear()
+            session.save()
+            self.output_text.clear()
 
         perform_btn.clicked.connect(on_perform)
+        new_session_btn.clicked.connect(on_new_session)
         cancel_btn.clicked.connect(dialog.close)
 
         dialog.exec_()
 
+    def generate_report(self, period):
+        reply = QMessageBox.question(self, "Report", f"Replace current note with the {period}ly report?", QMessageBox.Yes | QMessageBox.No)
+        if reply != QMessageBox.Yes:
+            return
+        reporter = DiaryReporter(self._llm_service, self._folder)
+
+        async def build():
+            # a message box runs a nested Qt loop, show the result after the asyncio tick instead of inside it
+            try:
+                report = await reporter.build_report(period, datetime.date.today())
+            except Exception as e:
+                QTimer.singleShot(0, lambda error=e: QMessageBox.warning(self, "Report", f"Failed to build the report: {error}"))
+                return
+            QTimer.singleShot(0, lambda: self.show_report(period, report))
+
+        self.run_async(build())
+
+    def show_report(self, period, report):
+        if not report:
+            QMessageBox.information(self, "Report", f"No diary found in this {period}")
+            return
+        self.file_name_entry.setText(f"{period}ly_report_{datetime.date.today().strftime(DATE_FORMAT)}.md")
+        self.text_area.setPlainText(report)
+
+    def get_block_sink(self, action):
+        if action == "insert into note":
+            return self.insert_block
+        if action == "save to file":
+            return FileSink(self._folder)
+        if action == "copy":
+            return lambda block: QApplication.clipboard().setText(block.to_text())
+        return None
+
+    def insert_block(self, block):
+        text = block.to_text()
+        if block.kind in (KIND_CODE, KIND_MARKDOWN) and block.lang not in ("markdown", "md"):
+            text = f"```{block.lang}\n{text}\n```"
+        self.text_area.moveCursor(QTextCursor.End)
+        self.text_area.insertPlainText(f"\n{text}\n")
+
     def quit_app(self):
         self.close()
 
+    def run_async(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        future.add_done_callback(self._on_async_done)
+        return future
+
+    def _on_async_done(self, future):
+        if not future.cancelled() and future.exception():
+            logger.error(f"async task failed: {future.exception()}")
+
     def _run_async_tasks(self):
-        self._loop.run_until_complete(asyncio.sleep(0))
-        QTimer.singleShot(100, self._run_async_tasks)
+        # drive the asyncio loop from the Qt loop, so the coroutines run on the GUI thread and may update widgets.
+        # a modal dialog opened from a coroutine re-enters the Qt loop while the asyncio loop is running, skip that tick
+        if not self._loop.is_running():
+            self._loop.run_until_complete(asyncio.sleep(0))
+        QTimer.singleShot(ASYNC_TICK_MS, self._run_async_tasks)
 
 
 if __name__ == "__main__":
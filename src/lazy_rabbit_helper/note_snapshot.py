@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import zlib
+import difflib
+import hashlib
+import threading
+from datetime import datetime
+
+from common_util import logger
+
+SNAPSHOT_DIR = ".snapshots"
+OBJECTS_DIR = "objects"
+INDEX_SUFFIX = ".index.jsonl"
+CHUNK_SIZE = 4096
+# compaction policy: keep every version within 1 day, one per hour within 1 week, then one per day
+KEEP_ALL_SECONDS = 24 * 3600
+HOURLY_SECONDS = 7 * 24 * 3600
+# margin for the mtime resolution of the file system when protecting the chunks written during a compaction
+MTIME_MARGIN_SECONDS = 2
+
+def sha1_hex(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+def split_chunks(content: str, chunk_size: int = CHUNK_SIZE) -> list[str]:
+    # cut on paragraph boundaries so an edit only changes the chunks around it
+    chunks = []
+    current = ""
+    for i, paragraph in enumerate(content.split("\n\n")):
+        # every paragraph but the first carries its separator, so joining the chunks gives the content back
+        piece = f"\n\n{paragraph}" if i else paragraph
+        if current and len(current) + len(piece) > chunk_size:
+            chunks.append(current)
+            current = piece
+        else:
+            current += piece
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+class NoteSnapshot:
+    def __init__(self, version: int, timestamp: float, digest: str, chunks: list[str]):
+        self.version = version
+        self.timestamp = timestamp
+        self.digest = digest
+        self.chunks = chunks
+
+    def to_dict(self) -> dict:
+        return {"version": self.version, "timestamp": self.timestamp, "digest": self.digest, "chunks": self.chunks}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "NoteSnapshot":
+        return cls(data["version"], data["timestamp"], data["digest"], data["chunks"])
+
+    def get_time_str(self) -> str:
+        return datetime.fromtimestamp(self.timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+    def __repr__(self) -> str:
+        return f"NoteSnapshot(version={self.version}, time={self.get_time_str()}, chunks={len(self.chunks)})"
+
+
+class NoteSnapshotStore:
+    """
+    Content-addressed history of the notes in a folder.
+
+    Every saved note is split into paragraph-aligned chunks which are stored once,
+    zlib-compressed and named by their sha1, so a save only writes the chunks that changed
+    plus one line in the index of the note. Saving identical content records nothing.
+    """
+
+    def __init__(self, folder: str):
+        self._root = os.path.join(folder, SNAPSHOT_DIR)
+        self._objects = os.path.join(self._root, OBJECTS_DIR)
+        self._lock = threading.Lock()
+        self._last_saved: dict[str, tuple[str, int]] = {}
+        os.makedirs(self._objects, exist_ok=True)
+
+    def _index_path(self, note_name: str) -> str:
+        return os.path.join(self._root, f"{note_name}{INDEX_SUFFIX}")
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def _write_object(self, data: bytes) -> str:
+        digest = sha1_hex(data)
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(data))
+            os.replace(tmp_path, path)
+        else:
+            # a reused chunk is as recent as a new one for a compaction running at the same time
+            os.utime(path)
+        return digest
+
+    def _read_object(self, digest: str) -> bytes:
+        with open(self._object_path(digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def _read_index(self, note_name: str) -> list[NoteSnapshot]:
+        index_path = self._index_path(note_name)
+        if not os.path.exists(index_path):
+            return []
+        snapshots = []
+        with open(index_path, "r", encoding="UTF-8") as f:
+            for line in f:
+                if line.strip():
+                    snapshots.append(NoteSnapshot.from_dict(json.loads(line)))
+        return snapshots
+
+    def _write_index(self, note_name: str, snapshots: list[NoteSnapshot]):
+        index_path = self._index_path(note_name)
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            for snapshot in snapshots:
+                f.write(json.dumps(snapshot.to_dict()) + "\n")
+        os.replace(tmp_path, index_path)
+
+    def record(self, note_name: str, content: str) -> NoteSnapshot | None:
+        digest = sha1_hex(content.encode("UTF-8"))
+        with self._lock:
+            if note_name not in self._last_saved:
+                snapshots = self._read_index(note_name)
+                self._last_saved[note_name] = (snapshots[-1].digest, snapshots[-1].version) if snapshots else ("", 0)
+            last_digest, last_version = self._last_saved[note_name]
+            if last_digest == digest:
+                return None
+            chunks = [self._write_object(chunk.encode("UTF-8")) for chunk in split_chunks(content)]
+            snapshot = NoteSnapshot(last_version + 1, time.time(), digest, chunks)
+            with open(self._index_path(note_name), "a", encoding="UTF-8") as f:
+                f.write(json.dumps(snapshot.to_dict()) + "\n")
+            self._last_saved[note_name] = (digest, snapshot.version)
+        return snapshot
+
+    def list_snapshots(self, note_name: str) -> list[NoteSnapshot]:
+        with self._lock:
+            return self._read_index(note_name)
+
+    def get_snapshot(self, note_name: str, version: int) -> NoteSnapshot | None:
+        for snapshot in self.list_snapshots(note_name):
+            if snapshot.version == version:
+                return snapshot
+        return None
+
+    def restore(self, note_name: str, version: int) -> str | None:
+        snapshot = self.get_snapshot(note_name, version)
+        if not snapshot:
+            return None
+        return b"".join(self._read_object(digest) for digest in snapshot.chunks).decode("UTF-8")
+
+    def restore_at(self, note_name: str, timestamp: float) -> str | None:
+        # the latest version saved at or before the given point in time
+        candidates = [s for s in self.list_snapshots(note_name) if s.timestamp <= timestamp]
+        if not candidates:
+            return None
+        return self.restore(note_name, candidates[-1].version)
+
+    def diff(self, note_name: str, version: int, content: str) -> str:
+        old_content = self.restore(note_name, version) or ""
+        lines = difflib.unified_diff(old_content.splitlines(keepends=True), content.splitlines(keepends=True),
+                                     fromfile=f"{note_name}@{version}", tofile=note_name)
+        return "".join(lines)
+
+    def compact(self, now: float = None) -> int:
+        """thin out old versions of every note and remove the chunks no longer referenced, return removed versions"""
+        # the lock is only held per index and per removed chunk, so a save during a compaction does not wait for it.
+        # the chunks written or reused by a save after scan_start are protected by their mtime
+        scan_start = time.time() - MTIME_MARGIN_SECONDS
+        now = now or time.time()
+        removed = 0
+        referenced = set()
+        for file_name in os.listdir(self._root):
+            if not file_name.endswith(INDEX_SUFFIX):
+                continue
+            note_name = file_name[:-len(INDEX_SUFFIX)]
+            with self._lock:
+                snapshots = self._read_index(note_name)
+                kept = self._thin_out(snapshots, now)
+                if len(kept) != len(snapshots):
+                    self._write_index(note_name, kept)
+                    removed += len(snapshots) - len(kept)
+            for snapshot in kept:
+                referenced.update(snapshot.chunks)
+        for sub_dir in os.listdir(self._objects):
+            sub_path = os.path.join(self._objects, sub_dir)
+            for digest in os.listdir(sub_path):
+                object_path = os.path.join(sub_path, digest)
+                if digest in referenced or os.path.getmtime(object_path) >= scan_start:
+                    continue
+                with self._lock:
+                    if os.path.exists(object_path) and os.path.getmtime(object_path) < scan_start:
+                        os.remove(object_path)
+        if removed:
+            logger.info(f"compacted {removed} snapshots in {self._root}")
+        return removed
+
+    def _thin_out(self, snapshots: list[NoteSnapshot], now: float) -> list[NoteSnapshot]:
+        kept = []
+        buckets = set()
+        # walk from the newest so each hour/day bucket keeps its latest version
+        for i, snapshot in enumerate(reversed(snapshots)):
+            age = now - snapshot.timestamp
+            if age <= KEEP_ALL_SECONDS:
+                kept.append(snapshot)
+                continue
+            bucket = int(snapshot.timestamp // 3600) if age <= HOURLY_SECONDS else -int(snapshot.timestamp // 86400)
+            # the newest version is always kept, it also takes its bucket
+            if i == 0 or bucket not in buckets:
+                buckets.add(bucket)
+                kept.append(snapshot)
+        kept.reverse()
+        return kept
+
+    def compact_in_background(self):
+        threading.Thread(target=self.compact, daemon=True).start()
@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import time
+import zlib
+import atexit
+import threading
+
+from common_util import logger
+
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_MAX_ENTRIES = 1000
+NUM_PERM = 64
+NUM_BANDS = 16
+SHINGLE_SIZE = 5
+BIN_BITS = 6
+VALUE_BITS = 32 - BIN_BITS
+VALUE_MASK = (1 << VALUE_BITS) - 1
+GOLDEN_RATIO_32 = 0x9E3779B1
+# bumped whenever get_signature changes, the persisted signatures are then computed again
+SIGNATURE_VERSION = 2
+SAVE_DELAY_SECONDS = 2.0
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def get_shingles(text: str, size: int = SHINGLE_SIZE) -> set[int]:
+    text = WHITESPACE_PATTERN.sub(" ", text.lower()).strip()
+    if len(text) <= size:
+        return {zlib.crc32(text.encode("UTF-8"))}
+    # prompts repeat a lot of shingles, dedupe the slices before hashing them
+    shingles = {text[i:i + size] for i in range(len(text) - size + 1)}
+    return {zlib.crc32(shingle.encode("UTF-8")) for shingle in shingles}
+
+def get_signature(text: str) -> list[int]:
+    """
+    One permutation MinHash: each shingle is hashed once, the top bits of the hash pick one of
+    the NUM_PERM bins and each bin keeps its minimum, instead of NUM_PERM hashes per shingle.
+    The empty bins borrow the value of the next non-empty bin, so the LSH bands stay comparable.
+    """
+    mins = [VALUE_MASK + 1] * NUM_PERM
+    for shingle in get_shingles(text):
+        h = (shingle * GOLDEN_RATIO_32) & 0xFFFFFFFF
+        b = h >> VALUE_BITS
+        v = h & VALUE_MASK
+        if v < mins[b]:
+            mins[b] = v
+    signature = []
+    for i in range(NUM_PERM):
+        for distance in range(NUM_PERM):
+            value = mins[(i + distance) % NUM_PERM]
+            if value <= VALUE_MASK:
+                signature.append(value + distance * (VALUE_MASK + 1))
+                break
+    return signature
+
+def estimate_similarity(sig1: list[int], sig2: list[int]) -> float:
+    return sum(1 for x, y in zip(sig1, sig2) if x == y) / len(sig1)
+
+
+class SimilarHit:
+    def __init__(self, answer: str, similarity: float, prompt: str, approximate: bool):
+        self.answer = answer
+        self.similarity = similarity
+        self.prompt = prompt
+        # the answer was given to another, only similar prompt
+        self.approximate = approximate
+
+    def __repr__(self) -> str:
+        return f"SimilarHit(similarity={self.similarity:.2f}, approximate={self.approximate})"
+
+
+class SimilarPromptCache:
+    """
+    Cache of LLM answers which also matches prompts differing only by a timestamp, whitespace or a typo.
+
+    Every prompt is fingerprinted by a MinHash signature over its character shingles, and the signatures
+    are indexed by LSH bands, so a lookup only compares the few entries sharing a band with the prompt.
+    The entries are kept per namespace (the prompt template name), persisted in a json file and evicted
+    in least recently used order beyond max_entries.
+    """
+
+    def __init__(self, cache_file: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self._cache_file = cache_file
+        self._max_entries = int(max_entries)
+        self._entries: dict[int, dict] = {}
+        self._bands: dict[tuple, set[int]] = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._last_signature = ("", [])
+        self._save_timer = None
+        if cache_file:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+            atexit.register(self.flush)
+        self.load()
+
+    def _get_signature(self, prompt: str) -> list[int]:
+        # a miss is usually followed by a put of the same prompt, compute its signature only once
+        last_prompt, signature = self._last_signature
+        if last_prompt != prompt or not signature:
+            signature = get_signature(prompt)
+            self._last_signature = (prompt, signature)
+        return signature
+
+    def _band_keys(self, namespace: str, signature: list[int]) -> list[tuple]:
+        rows = NUM_PERM // NUM_BANDS
+        return [(namespace, i, tuple(signature[i * rows:(i + 1) * rows])) for i in range(NUM_BANDS)]
+
+    def _index(self, entry_id: int, entry: dict):
+        for key in self._band_keys(entry["namespace"], entry["signature"]):
+            self._bands.setdefault(key, set()).add(entry_id)
+
+    def _unindex(self, entry_id: int, entry: dict):
+        for key in self._band_keys(entry["namespace"], entry["signature"]):
+            ids = self._bands.get(key)
+            if ids:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._bands[key]
+
+    def lookup(self, namespace: str, prompt: str, threshold: float = DEFAULT_THRESHOLD) -> SimilarHit | None:
+        signature = self._get_signature(prompt)
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(namespace, signature):
+                candidates.update(self._bands.get(key, ()))
+            best_id, best_similarity = None, 0.0
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                similarity = 1.0 if entry["prompt"] == prompt else estimate_similarity(signature, entry["signature"])
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None or best_similarity < threshold:
+                return None
+            entry = self._entries[best_id]
+            entry["last_used"] = time.time()
+            return SimilarHit(entry["answer"], best_similarity, entry["prompt"], entry["prompt"] != prompt)
+
+    def put(self, namespace: str, prompt: str, answer: str):
+        entry = {"namespace": namespace, "prompt": prompt, "answer": answer,
+                 "signature": self._get_signature(prompt), "last_used": time.time()}
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = entry
+            self._index(entry_id, entry)
+            self._evict()
+            # the answers of a burst of misses are written together by a background timer
+            if self._cache_file and self._save_timer is None:
+                self._save_timer = threading.Timer(SAVE_DELAY_SECONDS, self.save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _evict(self):
+        overflow = len(self._entries) - self._max_entries
+        if overflow <= 0:
+            return
+        for entry_id in sorted(self._entries, key=lambda i: self._entries[i]["last_used"])[:overflow]:
+            self._unindex(entry_id, self._entries.pop(entry_id))
+
+    def load(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return
+        try:
+            with open(self._cache_file, "r", encoding="UTF-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"cannot load prompt cache {self._cache_file}: {e}")
+            return
+        entries = data.get("entries", []) if isinstance(data, dict) else data
+        outdated = not isinstance(data, dict) or data.get("signature_version") != SIGNATURE_VERSION
+        with self._lock:
+            for entry in entries:
+                if outdated:
+                    entry["signature"] = get_signature(entry["prompt"])
+                entry_id = self._next_id
+                self._next_id += 1
+                self._entries[entry_id] = entry
+                self._index(entry_id, entry)
+            self._evict()
+
+    def save(self):
+        if not self._cache_file:
+            return
+        # copy the entries under the lock and write them outside of it, so lookups do not wait for the disk
+        with self._lock:
+            self._save_timer = None
+            data = {"signature_version": SIGNATURE_VERSION, "entries": [dict(e) for e in self._entries.values()]}
+        with self._save_lock:
+            tmp_file = f"{self._cache_file}.tmp"
+            with open(tmp_file, "w", encoding="UTF-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_file, self._cache_file)
+
+    def flush(self):
+        """write the pending answers now, instead of waiting for the background timer"""
+        with self._lock:
+            timer = self._save_timer
+        if timer:
+            timer.cancel()
+            self.save()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,269 @@
+import os
+import re
+import json
+from datetime import datetime
+from typing import Callable, Iterable
+
+from common_util import logger
+
+FENCE_PATTERN = re.compile(r"^\s*(`{3,}|~{3,})\s*([\w+\-.#]*)\s*$")
+CSV_SPLIT_PATTERN = re.compile(r"\s*,\s*")
+
+KIND_CODE = "code"
+KIND_MARKDOWN = "markdown"
+KIND_CSV_ROW = "csv_row"
+KIND_JSON = "json"
+
+FILE_EXTENSIONS = {
+    "python": "py", "py": "py", "javascript": "js", "js": "js", "typescript": "ts", "ts": "ts",
+    "java": "java", "go": "go", "rust": "rs", "cpp": "cpp", "c": "c", "shell": "sh", "bash": "sh",
+    "sh": "sh", "yaml": "yaml", "yml": "yaml", "sql": "sql", "html": "html", "markdown": "md",
+    "md": "md", "json": "json", "csv": "csv"
+}
+
+
+def is_closing_fence(fence: str, opening_fence: str) -> bool:
+    # a closing fence uses the same char as the opening one and is at least as long
+    return fence[0] == opening_fence[0] and len(fence) >= len(opening_fence)
+
+
+class ExtractedBlock:
+    def __init__(self, kind: str, content, lang: str = ""):
+        self.kind = kind
+        self.lang = lang
+        # str for code and markdown, dict for csv rows, parsed object for json
+        self.content = content
+
+    def to_text(self) -> str:
+        if isinstance(self.content, str):
+            return self.content
+        return json.dumps(self.content, indent=2, ensure_ascii=False)
+
+    def __repr__(self) -> str:
+        return f"ExtractedBlock(kind={self.kind}, lang={self.lang}, size={len(self.to_text())})"
+
+
+class JsonObjectScanner:
+    """
+    find the top-level json objects in a char stream by tracking brace depth outside of strings
+
+    In prose a "{" is often not json, with strict_start a candidate is dropped as soon as
+    its first non-space char is neither '"' nor '}', so an unmatched brace does not swallow the rest.
+    """
+
+    def __init__(self, strict_start: bool = False):
+        self._strict_start = strict_start
+        self.reset()
+
+    def reset(self):
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._head = False
+
+    def feed(self, text: str) -> list:
+        objects = []
+        pos = 0
+        while pos < len(text):
+            ch = text[pos]
+            pos += 1
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+                    self._buffer = [ch]
+                    self._head = self._strict_start
+                continue
+            if self._head and not ch.isspace():
+                self._head = False
+                if ch not in '"}':
+                    # not the start of an object, scan this char again outside of it
+                    self.reset()
+                    pos -= 1
+                    continue
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    raw = "".join(self._buffer)
+                    self.reset()
+                    try:
+                        objects.append(json.loads(raw))
+                    except ValueError as e:
+                        logger.warning(f"skip invalid json object: {e}")
+                        # an object may still start inside the invalid one, rescan from its next brace
+                        next_start = raw.find("{", 1)
+                        if next_start > 0:
+                            text = raw[next_start:] + text[pos:]
+                            pos = 0
+        return objects
+
+
+class StreamExtractor:
+    """
+    Incremental extractor of the blocks in a streamed LLM completion.
+
+    Tokens are fed as they arrive and split into lines; a small state machine tracks
+    whether we are inside a fenced block, so each fenced code or markdown block,
+    each csv row and each json object is emitted as soon as it is closed.
+    The fences nested in a markdown block are kept on a stack and belong to its content.
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._fence = None
+        self._lang = ""
+        self._lines = []
+        self._nested_fences = []
+        self._csv_headers = None
+        self._json_scanner = JsonObjectScanner()
+        self._prose_scanner = JsonObjectScanner(strict_start=True)
+
+    def feed(self, text: str) -> list[ExtractedBlock]:
+        self._pending += text
+        blocks = []
+        while True:
+            pos = self._pending.find("\n")
+            if pos < 0:
+                break
+            line = self._pending[:pos]
+            self._pending = self._pending[pos + 1:]
+            blocks.extend(self._handle_line(line))
+        return blocks
+
+    def close(self) -> list[ExtractedBlock]:
+        blocks = []
+        if self._pending:
+            line, self._pending = self._pending, ""
+            blocks.extend(self._handle_line(line))
+        if self._fence:
+            # the completion stopped inside a fence, flush what we got
+            blocks.extend(self._close_fence())
+        return blocks
+
+    def _handle_line(self, line: str) -> list[ExtractedBlock]:
+        match = FENCE_PATTERN.match(line)
+        if self._fence is None:
+            if match and match.group(2):
+                self._open_fence(match.group(1), match.group(2).lower())
+                return []
+            if match:
+                self._open_fence(match.group(1), "")
+                return []
+            return [ExtractedBlock(KIND_JSON, obj) for obj in self._prose_scanner.feed(line + "\n")]
+
+        if self._lang in ("markdown", "md") and match:
+            return self._handle_markdown_fence(line, match)
+        if match and not match.group(2) and is_closing_fence(match.group(1), self._fence):
+            return self._close_fence()
+        return self._handle_fenced_line(line)
+
+    def _handle_markdown_fence(self, line: str, match) -> list[ExtractedBlock]:
+        fence = match.group(1)
+        innermost = self._nested_fences[-1] if self._nested_fences else self._fence
+        if not match.group(2) and is_closing_fence(fence, innermost):
+            if not self._nested_fences:
+                return self._close_fence()
+            self._nested_fences.pop()
+        else:
+            # an info string, or a fence too short to close the innermost one, opens a nested block
+            self._nested_fences.append(fence)
+        self._lines.append(line)
+        return []
+
+    def _open_fence(self, fence: str, lang: str):
+        self._fence = fence
+        self._lang = lang
+        self._lines = []
+        self._nested_fences = []
+        self._csv_headers = None
+        self._json_scanner.reset()
+        self._prose_scanner.reset()
+
+    def _handle_fenced_line(self, line: str) -> list[ExtractedBlock]:
+        self._lines.append(line)
+        if self._lang == "csv":
+            if not line.strip():
+                return []
+            values = CSV_SPLIT_PATTERN.split(line.strip())
+            if self._csv_headers is None:
+                self._csv_headers = values
+                return []
+            return [ExtractedBlock(KIND_CSV_ROW, dict(zip(self._csv_headers, values)), self._lang)]
+        if self._lang == "json":
+            return [ExtractedBlock(KIND_JSON, obj, self._lang) for obj in self._json_scanner.feed(line + "\n")]
+        return []
+
+    def _close_fence(self) -> list[ExtractedBlock]:
+        content = "\n".join(self._lines)
+        lang = self._lang
+        self._fence = None
+        self._lang = ""
+        self._lines = []
+        self._nested_fences = []
+        self._json_scanner.reset()
+        if lang in ("csv", "json"):
+            # rows and objects have already been emitted one by one
+            return []
+        kind = KIND_MARKDOWN if lang in ("markdown", "md") else KIND_CODE
+        return [ExtractedBlock(kind, content, lang)]
+
+
+class FileSink:
+    """save every code or markdown block into its own file in the folder"""
+
+    def __init__(self, folder: str, prefix: str = "block"):
+        self._folder = folder
+        self._prefix = prefix
+        self._count = 0
+
+    def __call__(self, block: ExtractedBlock):
+        if block.kind not in (KIND_CODE, KIND_MARKDOWN):
+            return
+        self._count += 1
+        ext = FILE_EXTENSIONS.get(block.lang, "txt")
+        timestr = datetime.now().strftime("%Y%m%d_%H%M%S")
+        file_path = os.path.join(self._folder, f"{self._prefix}_{timestr}_{self._count}.{ext}")
+        with open(file_path, "w", encoding="UTF-8") as f:
+            f.write(block.to_text())
+        logger.info(f"saved {block} to {file_path}")
+
+
+class StreamPipeline:
+    def __init__(self, sinks: Iterable[Callable[[ExtractedBlock], None]] = (), kinds: Iterable[str] = None):
+        self._extractor = StreamExtractor()
+        self._sinks = list(sinks)
+        self._kinds = set(kinds) if kinds else None
+        self.blocks: list[ExtractedBlock] = []
+
+    def add_sink(self, sink: Callable[[ExtractedBlock], None]):
+        self._sinks.append(sink)
+
+    def feed(self, text: str) -> list[ExtractedBlock]:
+        return self._dispatch(self._extractor.feed(text))
+
+    def close(self) -> list[ExtractedBlock]:
+        return self._dispatch(self._extractor.close())
+
+    def _dispatch(self, blocks: list[ExtractedBlock]) -> list[ExtractedBlock]:
+        if self._kinds is not None:
+            blocks = [b for b in blocks if b.kind in self._kinds]
+        for block in blocks:
+            self.blocks.append(block)
+            for sink in self._sinks:
+                try:
+                    sink(block)
+                except Exception as e:
+                    logger.error(f"sink {sink} failed on {block}: {e}")
+        return blocks
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the local hot paths which do not call the LLM.
+
+    ./tests/benchmark.py                    # run and compare with the stored baseline
+    ./tests/benchmark.py --save-baseline    # run and store the result as the new baseline
+    ./tests/benchmark.py -k note -n 20      # only the benchmarks whose name contains "note"
+
+The fixture corpora are generated with a fixed seed into a temporary folder,
+StickyNote runs headless on the offscreen Qt platform.
+Each benchmark is timed for at least MIN_SECONDS, so the short ones get many more runs.
+After every run a calibration workload is timed for about as long as the run, and the min
+of the runs relative to the min of the calibration runs is compared: both are sampled over
+the same seconds and with the same length, so a host which is slower for a while,
+or a baseline of another host, still compare.
+The baseline is stored per host.
+"""
+import os
+import sys
+import json
+import time
+import gc
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, "src", "lazy_rabbit_helper"))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import yaml
+from yaml_config import YamlConfig
+from llm_service import LlmService, LlmConfig
+from common_util import task_csv_to_json, extract_markdown_text
+
+DEFAULT_BASELINE_FILE = os.path.join(CURRENT_DIR, "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 0.3
+DEFAULT_REPEAT = 10
+MIN_SECONDS = 2.0
+MAX_REPEAT = 1000
+BASELINE_ROUNDS = 3
+CONFIRM_ROUNDS = 3
+PROMPT_TEMPLATE_FILE = os.path.join(PROJECT_DIR, "etc", "prompt_template.yaml")
+STICKY_NOTE_CONFIG_FILE = os.path.join(PROJECT_DIR, "etc", "sticky_note.yaml")
+WORDS = ["lazy", "rabbit", "note", "task", "design", "review", "code", "test", "summary", "meeting",
+         "deadline", "priority", "learn", "write", "plan", "check", "日程", "总结", "任务", "学习"]
+
+g_app = None
+
+def random_text(rnd: random.Random, word_count: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(word_count))
+
+def generate_large_config(rnd: random.Random, file_path: str, section_count: int = 2000):
+    data = {"config": yaml.safe_load(open(STICKY_NOTE_CONFIG_FILE, encoding="UTF-8"))["config"]}
+    for i in range(section_count):
+        data[f"prompt_{i}"] = {
+            "desc": random_text(rnd, 5),
+            "system_prompt": random_text(rnd, 20),
+            "user_prompt": random_text(rnd, 80) + " {{ text }}",
+            "variables": {"text": random_text(rnd, 10)},
+            "tags": rnd.choice(WORDS)
+        }
+    with open(file_path, "w", encoding="UTF-8") as f:
+        yaml.safe_dump(data, f, allow_unicode=True)
+
+def generate_task_csv(rnd: random.Random, row_count: int = 50000) -> str:
+    lines = ["title, priority, difficulty, duration, deadline"]
+    for _ in range(row_count):
+        lines.append(f"{random_text(rnd, 3)}, {rnd.randint(1, 3)}, {rnd.randint(1, 3)}, {rnd.choice([30, 60, 120])}, 2025-06-07")
+    return "\n".join(lines)
+
+def generate_llm_answer(rnd: random.Random, paragraph_count: int = 20000) -> str:
+    # the markdown block is at the end, so the search has to scan the whole answer
+    paragraphs = [random_text(rnd, 30) for _ in range(paragraph_count)]
+    return "\n\n".join(paragraphs) + "\n```markdown\n" + "\n".join(paragraphs[:1000]) + "\n```\n"
+
+def generate_note(rnd: random.Random, size_mb: float = 2.0) -> str:
+    lines = []
+    size = 0
+    while size < size_mb * 1024 * 1024:
+        line = f"* [ ] {random_text(rnd, 12)}" if rnd.random() < 0.3 else random_text(rnd, 20)
+        if rnd.random() < 0.05:
+            line = f"\n## {random_text(rnd, 3)}\n"
+        lines.append(line)
+        size += len(line.encode("UTF-8")) + 1
+    return "\n".join(lines)
+
+
+class Benchmark:
+    def __init__(self, name: str, func, setup=None):
+        self.name = name
+        self.func = func
+        self.setup = setup
+
+    def run(self, repeat: int, min_seconds: float = MIN_SECONDS) -> dict:
+        # an untimed warm-up run, so the first timed run does not pay for imports and lazy caches
+        if self.setup:
+            self.setup()
+        self.func()
+        durations = []
+        calibrations = []
+        # like timeit, keep the garbage collector out of the timed runs.
+        # a full collection takes ~100 ms here, so it only runs once and not before every run
+        gc.collect()
+        deadline = time.perf_counter() + min_seconds
+        while len(durations) < repeat or (time.perf_counter() < deadline and len(durations) < MAX_REPEAT):
+            if self.setup:
+                self.setup()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                self.func()
+                duration = (time.perf_counter() - start) * 1000
+                durations.append(duration)
+                # interleave the calibration and make it as long as the run, so it sees the same speed of the host.
+                # a short one would slip through the fast moments of a host which a long run cannot avoid
+                count = max(1, round(duration / calibrations[-1])) if calibrations else 1
+                calibrations.append(calibrate(count))
+            finally:
+                gc.enable()
+        # the peak memory is measured in a separate run, tracemalloc slows down the timed runs
+        if self.setup:
+            self.setup()
+        tracemalloc.start()
+        self.func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"median_ms": round(statistics.median(durations), 3),
+                "min_ms": round(min(durations), 3),
+                "runs": len(durations),
+                "peak_kb": round(peak / 1024, 1),
+                "calibration_ms": round(min(calibrations), 4),
+                "relative": round(min(durations) / min(calibrations), 4)}
+
+
+def create_benchmarks(work_dir: str) -> list[Benchmark]:
+    rnd = random.Random(20250607)
+    benchmarks = []
+
+    config_file = os.path.join(work_dir, "large_config.yaml")
+    generate_large_config(rnd, config_file)
+    benchmarks.append(Benchmark("yaml_config.read_config", lambda: YamlConfig(config_file)))
+
+    llm_service = LlmService(LlmConfig(api_key="benchmark", base_url="http://localhost", model="benchmark",
+                                       cassette_mode="off"), PROMPT_TEMPLATE_FILE)
+    prompt_templates = llm_service.get_prompt_templates()
+    prompts = [prompt_templates.get_prompt_tpl(name) for name in prompt_templates.get_prompts()]
+    prompts = [p for p in prompts if isinstance(p, dict) and p.get("user_prompt")]
+
+    def build_all_prompts():
+        for prompt in prompts:
+            llm_service.build_prompt(prompt.get("variables") or {}, f"{prompt.get('system_prompt', '')}\n{prompt['user_prompt']}")
+
+    def clear_compiled_templates():
+        llm_service._compiled_templates.clear()
+
+    # build_prompt keeps the compiled templates: measure the first call, which compiles and renders,
+    # and the later ones, which only render, separately
+    benchmarks.append(Benchmark("llm_service.build_prompt", build_all_prompts, setup=clear_compiled_templates))
+    benchmarks.append(Benchmark("llm_service.build_prompt_cached", build_all_prompts, setup=build_all_prompts))
+
+    task_csv = generate_task_csv(rnd)
+    benchmarks.append(Benchmark("common_util.task_csv_to_json", lambda: task_csv_to_json(task_csv)))
+
+    llm_answer = generate_llm_answer(rnd)
+    benchmarks.append(Benchmark("common_util.extract_markdown_text", lambda: extract_markdown_text(llm_answer)))
+
+    benchmarks.extend(create_note_benchmarks(rnd, work_dir))
+    return benchmarks
+
+def create_note_benchmarks(rnd: random.Random, work_dir: str) -> list[Benchmark]:
+    try:
+        from PyQt5.QtWidgets import QApplication
+        from main import StickyNote
+    except ImportError as e:
+        print(f"skip the StickyNote benchmarks: {e}")
+        return []
+
+    note_folder = os.path.join(work_dir, "notes")
+    os.makedirs(note_folder, exist_ok=True)
+    config = yaml.safe_load(open(STICKY_NOTE_CONFIG_FILE, encoding="UTF-8"))
+    config["config"]["folder"] = note_folder
+    config["config"]["save_interval_ms"] = 3600000
+    config["llm"]["api_key"] = None
+    config_file = os.path.join(work_dir, "sticky_note.yaml")
+    with open(config_file, "w", encoding="UTF-8") as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+
+    # keep the application alive as long as the benchmarks, its widgets are deleted with it
+    global g_app
+    g_app = QApplication.instance() or QApplication(sys.argv)
+    window = StickyNote(config_file, PROMPT_TEMPLATE_FILE, "diary")
+    window.timer.stop()
+    window.file_name_entry.setText("benchmark_note.md")
+    note = generate_note(rnd)
+    window.text_area.setPlainText(note)
+    edits = iter(range(1000000))
+
+    def edit_note():
+        # every save has to write a new version, otherwise the snapshot store skips it
+        window.text_area.setPlainText(f"{note}\n{next(edits)}")
+
+    return [
+        Benchmark("sticky_note.save_note", lambda: window.save_note(False), setup=edit_note),
+        Benchmark("sticky_note.load_note", window.load_note)
+    ]
+
+
+CALIBRATION_DATA = [{"id": i, "name": f"item {i}", "tags": [str(i % 7), str(i % 13)]} for i in range(400)]
+
+def calibrate(count: int = 1) -> float:
+    """run a fixed pure python workload of ~1 ms count times, return the average ms of one"""
+    start = time.perf_counter()
+    for _ in range(count):
+        text = json.dumps(CALIBRATION_DATA)
+        json.loads(text)
+        sorted(CALIBRATION_DATA, key=lambda x: (x["tags"][1], -x["id"]))
+        hashlib.sha1(text.encode("UTF-8")).hexdigest()
+    return (time.perf_counter() - start) * 1000 / count
+
+def select_baseline(baselines: dict, host: str) -> tuple[str, dict] | tuple[None, None]:
+    if host in baselines:
+        return host, baselines[host]
+    for other_host, baseline in baselines.items():
+        return other_host, baseline
+    return None, None
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float) -> list[str]:
+    # the min of the runs is the least noisy, it is compared relative to the calibration interleaved with it
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if base["relative"] > 0 and result["relative"] > base["relative"] * (1 + threshold):
+            regressions.append(f"{name}.relative: {base['relative']} -> {result['relative']} x calibration")
+        if base["peak_kb"] > 0 and result["peak_kb"] > base["peak_kb"] * (1 + threshold):
+            regressions.append(f"{name}.peak_kb: {base['peak_kb']} -> {result['peak_kb']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the non-LLM core paths")
+    parser.add_argument('-n', '--repeat', action='store', dest='repeat', type=int, default=DEFAULT_REPEAT, help='min timed runs per benchmark, short ones run for MIN_SECONDS')
+    parser.add_argument('-k', '--keyword', action='store', dest='keyword', default="", help='only run the benchmarks whose name contains it')
+    parser.add_argument('-b', '--baseline', action='store', dest='baseline', default=DEFAULT_BASELINE_FILE, help='baseline file')
+    parser.add_argument('-t', '--threshold', action='store', dest='threshold', type=float, default=DEFAULT_THRESHOLD, help='allowed regression ratio, 0.3 means 30%%')
+    parser.add_argument('-s', '--save-baseline', action='store_true', dest='save_baseline', help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    host = platform.node()
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="UTF-8") as f:
+            baselines = json.load(f)
+    baseline_host, baseline = select_baseline(baselines, host)
+    if not args.save_baseline:
+        if not baseline:
+            print(f"no baseline in {args.baseline}, run with --save-baseline first")
+        elif baseline_host != host:
+            print(f"no baseline of {host}, compare with the one of {baseline_host} relative to the calibration")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for benchmark in create_benchmarks(work_dir):
+            if args.keyword not in benchmark.name:
+                continue
+            if args.save_baseline:
+                # the baseline is the typical round rather than the luckiest one
+                rounds = sorted((benchmark.run(args.repeat) for _ in range(BASELINE_ROUNDS)), key=lambda r: r["relative"])
+                result = rounds[len(rounds) // 2]
+            else:
+                result = benchmark.run(args.repeat)
+            for _ in range(CONFIRM_ROUNDS):
+                if not baseline or args.save_baseline or not compare_with_baseline({benchmark.name: result}, baseline, args.threshold):
+                    break
+                # confirm a regression with more runs, a slow phase of the host may last several seconds
+                print(f"{benchmark.name:40s} slower than the baseline, run it again")
+                retry = benchmark.run(args.repeat)
+                result = min(result, retry, key=lambda r: r["relative"])
+                result["peak_kb"] = min(result["peak_kb"], retry["peak_kb"])
+            results[benchmark.name] = result
+            print(f"{benchmark.name:40s} {json.dumps(result)}")
+
+    if args.save_baseline:
+        baselines.setdefault(host, {}).update(results)
+        with open(args.baseline, "w", encoding="UTF-8") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"saved baseline of {host} to {args.baseline}")
+        return 0
+
+    if not baseline:
+        return 0
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
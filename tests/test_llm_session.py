@@ -0,0 +1,60 @@
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(CURRENT_DIR), "src", "lazy_rabbit_helper"))
+
+from llm_session import LlmSession, estimate_tokens
+
+TOKEN_BUDGET = 4096
+
+def ask(session: LlmSession, user_prompt: str, answer: str) -> bool:
+    # the same steps as LlmService.ask_in_session, the summary stands in for the compaction call
+    compacted = False
+    if session.need_compact(user_prompt):
+        count = session.get_compact_count(user_prompt)
+        session.apply_compact(f"summary of {count} more turns " + session.summary[:400], count)
+        compacted = True
+    assert session.count_tokens(user_prompt) <= session.token_budget
+    session.add_turn(user_prompt, answer)
+    return compacted
+
+
+def test_compaction_is_rare_and_keeps_the_prefix():
+    session = LlmSession("You are a helpful assistant.", TOKEN_BUDGET)
+    question = "q" * 1000  # ~250 tokens
+    answer = "a" * 2800    # ~700 tokens
+    turn_count = 60
+    compactions = 0
+    prefix = None
+    prefix_changes = 0
+    for i in range(turn_count):
+        if ask(session, f"{i} {question}", answer):
+            compactions += 1
+        current = session.build_messages("")[:2]
+        if current != prefix:
+            prefix_changes += 1
+            prefix = current
+    # each turn takes ~950 tokens, a compaction frees half of the budget: at most one per three turns
+    assert 0 < compactions <= turn_count // 3
+    # the prefix only changes at a compaction, besides the first turn
+    assert prefix_changes == compactions + 1
+
+def test_no_compaction_within_budget():
+    session = LlmSession("system", TOKEN_BUDGET)
+    for i in range(3):
+        assert not ask(session, f"question {i}", "short answer")
+    assert session.get_compact_count("next") == 0
+
+def test_large_prompt_folds_all_turns():
+    session = LlmSession("system", 100, keep_turns=2)
+    session.add_turn("x" * 40, "y" * 40)
+    session.add_turn("x" * 40, "y" * 40)
+    assert session.get_compact_count("z" * 300) == 2
+
+def test_summary_is_capped():
+    session = LlmSession("system", 400)
+    session.add_turn("question", "answer")
+    session.apply_compact("s" * 10000, 1)
+    assert estimate_tokens(session.summary) <= 100
+    assert session.turns == []
@@ -0,0 +1,78 @@
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(CURRENT_DIR), "src", "lazy_rabbit_helper"))
+
+from stream_extractor import StreamPipeline, KIND_CODE, KIND_MARKDOWN, KIND_CSV_ROW, KIND_JSON
+
+NESTED_ANSWER = """Here is the note:
+```markdown
+# Commands
+list the files:
+```bash
+ls -l
+```
+done
+```
+and the data {"name": "rabbit", "tags": ["lazy", "}"]}
+```csv
+title, priority
+write code, 1
+review, 2
+```
+"""
+
+def extract(text: str, chunk_size: int = 0) -> list:
+    blocks = []
+    pipeline = StreamPipeline([blocks.append])
+    if chunk_size:
+        for i in range(0, len(text), chunk_size):
+            pipeline.feed(text[i:i + chunk_size])
+    else:
+        pipeline.feed(text)
+    pipeline.close()
+    return [(b.kind, b.lang, b.content) for b in blocks]
+
+
+def test_nested_fence_in_markdown():
+    assert extract(NESTED_ANSWER) == [
+        (KIND_MARKDOWN, "markdown", "# Commands\nlist the files:\n```bash\nls -l\n```\ndone"),
+        (KIND_JSON, "", {"name": "rabbit", "tags": ["lazy", "}"]}),
+        (KIND_CSV_ROW, "csv", {"title": "write code", "priority": "1"}),
+        (KIND_CSV_ROW, "csv", {"title": "review", "priority": "2"}),
+    ]
+
+def test_chunk_boundaries_split_fence_lines():
+    expected = extract(NESTED_ANSWER)
+    for chunk_size in (1, 2, 3, 5, 7):
+        assert extract(NESTED_ANSWER, chunk_size) == expected
+
+def test_longer_outer_fence():
+    text = "````markdown\n```\nplain\n```\n````\n"
+    assert extract(text) == [(KIND_MARKDOWN, "markdown", "```\nplain\n```")]
+
+def test_code_block_is_emitted_when_closed():
+    blocks = []
+    pipeline = StreamPipeline([blocks.append])
+    pipeline.feed("```python\nprint('}')\n")
+    assert blocks == []
+    pipeline.feed("```\nmore text")
+    assert [(b.kind, b.lang, b.content) for b in blocks] == [(KIND_CODE, "python", "print('}')")]
+
+def test_unterminated_fence_is_flushed_on_close():
+    assert extract("```go\nfunc main() {}") == [(KIND_CODE, "go", "func main() {}")]
+
+def test_json_objects_in_json_fence():
+    text = '```json\n[{"a": "x}", "b": {"c": 1}},\n {"d": 2}]\n```\n'
+    assert extract(text, 4) == [(KIND_JSON, "json", {"a": "x}", "b": {"c": 1}}), (KIND_JSON, "json", {"d": 2})]
+
+def test_unmatched_brace_in_prose():
+    text = 'The set {1, 2 is open here.\nNow the object: {"a": 1}\nand {"b": 2}\n'
+    expected = [(KIND_JSON, "", {"a": 1}), (KIND_JSON, "", {"b": 2})]
+    assert extract(text) == expected
+    assert extract(text, 3) == expected
+
+def test_invalid_object_is_rescanned_from_next_brace():
+    text = 'see {"a": 1, oops {"b": 2}} and {"c": 3}\n'
+    assert extract(text, 2) == [(KIND_JSON, "", {"b": 2}), (KIND_JSON, "", {"c": 3})]